@@ -0,0 +1,109 @@
+import numpy as np
+from os.path import exists
+from pandas import Timestamp, Timedelta, date_range
+
+from utils import len_month, prepare_filenames, stats_name, state_name
+from climatology import check_stats
+from run_day import season_grid, new_state, run_season, save_month, save_season, save_state, load_state
+from result_cache import season_key, month_keys, unlink_season
+
+import CONFIG as cfg
+
+# Advance snow year YYYY from the state saved by the previous call (or from
+# August 1 if there is none), by one day or up to a target date:
+#     python BTIM_daily.py YYYY X
+#     python BTIM_daily.py YYYY X --until YYYY-MM-DD
+
+# ------- Initialize -------- #
+
+snow_season = [cfg.year, cfg.year+1]
+t2m_files, tp_files = prepare_filenames(cfg.forcing, cfg.data_loc, snow_season)
+
+year_tag = str(snow_season[0])+'_'+str(snow_season[1])
+first_time, last_time = Timestamp(snow_season[0], 8, 1), Timestamp(snow_season[1], 7, 31)
+
+fname = state_name(cfg.Unique_ID, cfg.output_loc, cfg.mixed_pr, year_tag)
+
+if exists(fname):
+    state_lats, state_lons, date, state, snf_record, density_record = load_state(fname)
+    if date == last_time:
+        raise SystemExit('Snow year ' + year_tag + ' is already complete')
+    date = date + Timedelta(days=1)
+else:
+    state, date = None, first_time
+
+if date.day > len_month(date.month, date.year, cfg.leapdays): #Feb 29 without leapdays
+    date = date + Timedelta(days=1)
+
+# ---- Run up to the target date, one day by default ---- #
+until = date if cfg.until is None else min(Timestamp(cfg.until), last_time)
+if until.day > len_month(until.month, until.year, cfg.leapdays): #Feb 29 without leapdays
+    until = until - Timedelta(days=1)
+if until < date:
+    raise SystemExit('Snow year ' + year_tag + ' has already been run past ' + str(until.date()))
+
+print('Processing snow year: ' + year_tag + ', ' + str(date.date()) + ' to ' + str(until.date()))
+
+grid = season_grid(cfg.forcing, t2m_files, tp_files, cfg.latminmax, cfg.region)
+lats, lons = grid['lats'], grid['lons']
+
+nlats, nlons = lats.size, lons.size
+
+if state is None:
+    state = new_state(nlats, nlons, grid['cellmask'])
+elif not (np.array_equal(state_lats, lats) and np.array_equal(state_lons, lons)):
+    raise ValueError('The grid of ' + fname + ' does not match the current region; '
+                     'remove it to restart snow year ' + year_tag)
+
+# --- Check the climatology before anything is removed or run --- #
+cover_files = [] if cfg.landcover_file is None else [cfg.landcover_file]
+clim_fname, clim_keys, clim_key = None, {}, None
+if cfg.climatology:
+    clim_fname = stats_name(cfg.Unique_ID, cfg.output_loc, cfg.mixed_pr, cfg.clim_worker)
+    clim_keys = month_keys(t2m_files, tp_files, cover_files, cfg.result_settings, snow_season,
+                           range((date.month - 8) % 12, (until.month - 8) % 12 + 1), cfg.cache_hash_contents)
+    if until == last_time: #later months may not be on disk before
+        clim_key = season_key(t2m_files + tp_files + cover_files, cfg.result_settings, cfg.cache_hash_contents)
+    check_stats(clim_fname, lats, lons, year_tag, clim_key, clim_keys)
+
+if date == first_time:
+    unlink_season(cfg.Unique_ID, cfg.output_loc, cfg.mixed_pr, year_tag)
+
+# ------- Run the new days ------- #
+for item in run_season(grid, cfg.forcing, cfg.mixed_pr, t2m_files, tp_files, snow_season,
+                       cfg.leapdays, cfg.max_mem, cfg.landcover_file, state, date, until,
+                       cfg.climatology, cfg.point_store):
+
+    if isinstance(item, dict): #annual records, kept in state
+        continue
+
+    date, depth, density, swe = item
+    days_in_month = len_month(date.month, date.year, cfg.leapdays)
+    print('day ', str(date.date()))
+
+    # ----- Set up daily records for the month ----- #
+    if date.day == 1:
+        snf_record = np.zeros((nlats, nlons, days_in_month)) #[m snow], snow depth
+        density_record = np.zeros((nlats, nlons, days_in_month)) #[kg/m3], snow density
+    elif snf_record.shape[2] < days_in_month: #month so far, from the saved state
+        rest = np.zeros((nlats, nlons, days_in_month - snf_record.shape[2]))
+        snf_record = np.concatenate((snf_record, rest), axis=2)
+        density_record = np.concatenate((density_record, rest), axis=2)
+
+    snf_record[:,:,date.day-1] = depth #[m snow]
+    density_record[:,:,date.day-1] = density #[kg/m3]
+
+    # --- Write the month when it is complete, or the month so far at the end --- #
+    month_complete = date.day == days_in_month
+    if month_complete or (date == until):
+        times = date_range(str(date.year)+'-'+str(date.month).zfill(2)+'-'+'01', periods=date.day, freq='D')
+        save_month(cfg.Unique_ID, cfg.output_loc, cfg.mixed_pr, year_tag, (date.month - 8) % 12,
+                   lats, lons, times, snf_record[:,:,:date.day], density_record[:,:,:date.day],
+                   clim_fname if month_complete else None, #partial months are not added to the climatology
+                   clim_keys.get(times[0].strftime('%Y-%m'), ''))
+
+if until == last_time:
+    save_season(cfg.Unique_ID, cfg.output_loc, cfg.mixed_pr, year_tag, lats, lons,
+                state, first_time, last_time, clim_fname, cfg.point_store, clim_key)
+
+save_state(fname, lats, lons, until, state, snf_record[:,:,:until.day], density_record[:,:,:until.day])
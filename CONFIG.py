@@ -5,10 +5,38 @@ import sys
 year = int(sys.argv[1])
 
 forcing = str(sys.argv[2])
+
+### optional memory budget, e.g. python BTIM.py YYYY X --max-mem 8G
+### the grid is then stepped in bands of rows small enough to fit
+max_mem = None
+if '--max-mem' in sys.argv:
+    max_mem = sys.argv[sys.argv.index('--max-mem') + 1]
+
+### BTIM_daily.py only: run every day up to and including this date in one
+### call, e.g. python BTIM_daily.py YYYY X --until YYYY-MM-DD; by default a
+### single day is run
+until = None
+if '--until' in sys.argv:
+    until = sys.argv[sys.argv.index('--until') + 1]
+
 data_loc = 'forcing/'
 
 mixed_pr = [0,0] #if equal, no mixed precipitation
 latminmax = [40,90] 
+
+### optional list of boxes [lat_min, lat_max, lon_min, lon_max] replacing latminmax;
+### only these parts of the forcing files are read. Boxes may cross the
+### 0/360 or -180/180 seam, e.g. Alaska/Yukon: [[54, 72, -170, -123]],
+### Scandinavia: [[55, 71, 4, 32]]. With several boxes the model grid is the
+### union of their latitudes times the union of their longitudes; cells of
+### it outside every box are neither read nor run, and are nan in the output.
+region = None
+
+### optional netCDF file with the land cover of the forcing grid: icl
+### (1: tundra, 2: boreal forest, 5: prairie, 6: dense cold settling) and
+### iopen (1: open, 0: forest canopy). None treats every cell as open tundra.
+landcover_file = None
+
 leapdays = True
 
 ### Unique_ID will be used to name output files
@@ -17,5 +45,30 @@ Unique_ID = forcing
 output_loc = 'output/'
 if not exists(output_loc):
     makedirs(output_loc)
+
+### reuse the output of seasons whose forcing files, settings and model
+### code are unchanged since they were last run; set cache_hash_contents
+### to hash the forcing files instead of checking size and modification time
+use_cache = True
+cache_loc = output_loc + 'cache/'
+cache_hash_contents = False
+
+### running climatology (mean, std, trend) updated after each season;
+### a season or month already in it is only accepted again if its inputs
+### are unchanged (see result_settings). Jobs running at the same time need their own clim_worker tag;
+### combine with: python climatology.py merge merged.nc <worker files>
+climatology = False
+clim_worker = 'main'
+
+### rewrite each season's daily output as a time-chunked point store
+### for fast station queries (see point_index.py); this doubles the disk
+### space used by the daily output
+point_store = False
     
     
+
+### settings that change the model output; seasons are cached and added to
+### the climatology under a key made from these and the input files
+result_settings = {'forcing': forcing, 'year': year, 'mixed_pr': mixed_pr,
+                   'latminmax': latminmax, 'region': region, 'leapdays': leapdays,
+                   'landcover_file': landcover_file}
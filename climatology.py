@@ -0,0 +1,420 @@
+import sys
+import json
+from os.path import exists
+
+import numpy as np
+from netCDF4 import Dataset
+from pandas import Timestamp
+
+annual_vars = ['ptot', 'sftot', 'swemax']
+daily_vars = ['snow_depth']
+
+# running sums kept per cell for every variable; x is the season start year
+# and y is the model output, so the trend is in [units / year]
+stat_fields = ['n', 'xmean', 'ymean', 'xm2', 'ym2', 'cxy']
+
+n_season_days = 366 #Aug 1 to Jul 31 of a season ending in a leap year
+
+# grid rows updated at a time, so that adding a month to the statistics
+# does not hold a month of every field on the whole grid
+stats_band = 8
+
+def season_day(m, d):
+    '''Day-of-season slot (Aug 1 = 0) of a calendar day, laid out as in a
+       season ending in a leap year so that Feb 29 always has its own slot.
+
+    Args:
+        m (int): month number (Jan = 1)
+        d (int): day of month
+
+    Returns:
+        slot (int): index along the day dimension of a statistics file
+    '''
+
+    ref_year = 1999 if m >= 8 else 2000
+
+    return (Timestamp(ref_year, m, d) - Timestamp(1999, 8, 1)).days
+
+def empty_stats(shape):
+    '''Running statistics for zero samples.'''
+
+    stats = {f: np.zeros(shape) for f in stat_fields}
+    stats['n'] = np.zeros(shape, dtype='int32')
+
+    return stats
+
+def update_stats(stats, x, y):
+    '''Add one sample per cell to the running statistics using Welford's
+       algorithm for the means and (co)variances. Cells where y is not
+       finite are left untouched.
+
+    Args:
+        stats (dict): running statistics, see stat_fields
+        x (float): season start year
+        y (ndarray): sample, same shape as the arrays in stats
+
+    Returns:
+        stats (dict): updated running statistics
+    '''
+
+    y = np.asarray(y, dtype='float64')
+    valid = np.isfinite(y)
+
+    n = stats['n'] + valid
+    dx = np.where(valid, x - stats['xmean'], 0.)
+    dy = np.where(valid, y - stats['ymean'], 0.)
+
+    xmean = stats['xmean'] + np.divide(dx, n, out=np.zeros_like(dx), where=n > 0)
+    ymean = stats['ymean'] + np.divide(dy, n, out=np.zeros_like(dy), where=n > 0)
+
+    stats['xm2'] = stats['xm2'] + dx * np.where(valid, x - xmean, 0.)
+    stats['ym2'] = stats['ym2'] + dy * np.where(valid, y - ymean, 0.)
+    stats['cxy'] = stats['cxy'] + dx * np.where(valid, y - ymean, 0.)
+    stats['n'], stats['xmean'], stats['ymean'] = n, xmean, ymean
+
+    return stats
+
+def merge_stats(a, b):
+    '''Combine running statistics accumulated over disjoint sets of seasons
+       (Chan et al., 1979).
+
+    Args:
+        a (dict): running statistics, see stat_fields
+        b (dict): running statistics of the same shape as a
+
+    Returns:
+        merged (dict): statistics equivalent to accumulating a and b together
+    '''
+
+    n = a['n'] + b['n']
+    wb = np.divide(b['n'], n, out=np.zeros(n.shape), where=n > 0)
+    dx = b['xmean'] - a['xmean']
+    dy = b['ymean'] - a['ymean']
+
+    merged = {
+        'n': n,
+        'xmean': a['xmean'] + dx * wb,
+        'ymean': a['ymean'] + dy * wb,
+        'xm2': a['xm2'] + b['xm2'] + dx * dx * a['n'] * wb,
+        'ym2': a['ym2'] + b['ym2'] + dy * dy * a['n'] * wb,
+        'cxy': a['cxy'] + b['cxy'] + dx * dy * a['n'] * wb,
+    }
+
+    return merged
+
+def finalize_stats(stats):
+    '''Climatological mean, standard deviation and linear trend.
+
+    Args:
+        stats (dict): running statistics, see stat_fields
+
+    Returns:
+        mean (ndarray): mean over all seasons, nan where n = 0
+        std (ndarray): sample standard deviation, nan where n < 2
+        trend (ndarray): least squares slope [units / year], nan where
+            fewer than two distinct seasons were seen
+    '''
+
+    n = stats['n']
+
+    mean = np.where(n > 0, stats['ymean'], np.nan)
+    std = np.sqrt(np.divide(stats['ym2'], n - 1, out=np.full(n.shape, np.nan), where=n > 1))
+    trend = np.divide(stats['cxy'], stats['xm2'], out=np.full(n.shape, np.nan), where=stats['xm2'] > 0)
+
+    return mean, std, trend
+
+def create_stats_file(fname, lats, lons):
+    '''Set up an empty running statistics file on the model grid.'''
+
+    nc = Dataset(fname, 'w')
+    nc.createDimension('day', n_season_days)
+    nc.createDimension('lat', lats.size)
+    nc.createDimension('lon', lons.size)
+
+    nc.createVariable('lat', 'f8', ('lat',))[:] = lats
+    nc.createVariable('lon', 'f8', ('lon',))[:] = lons
+    nc['lat'].setncatts({'long_name':'latitude', 'units':'degrees_north'})
+    nc['lon'].setncatts({'long_name':'longitude', 'units':'degrees_east'})
+
+    # chunks match the access pattern: one band of rows (of one day slot)
+    # at a time, see update_daily_stats and merge_stats_files; the fill
+    # value of 0 means no zeros have to be written here
+    band_chunk = (min(stats_band, lats.size), lons.size)
+    for v in annual_vars + daily_vars:
+        dims = ('lat', 'lon') if v in annual_vars else ('day', 'lat', 'lon')
+        chunks = band_chunk if v in annual_vars else (1,) + band_chunk
+        for f in stat_fields:
+            nc.createVariable(f'{v}_{f}', 'i4' if f == 'n' else 'f8', dims,
+                              zlib=True, chunksizes=chunks, fill_value=0)
+
+    nc.seasons = ''
+    nc.months = ''
+    nc.seasons_keys = '{}'
+    nc.months_keys = '{}'
+    nc.close()
+
+def read_stats(nc, var, index=Ellipsis):
+    '''Read running statistics of one variable from an open file.'''
+
+    return {f: nc[f'{var}_{f}'][index] for f in stat_fields}
+
+def write_stats(nc, var, stats, index=Ellipsis):
+    '''Write running statistics of one variable to an open file.'''
+
+    for f in stat_fields:
+        nc[f'{var}_{f}'][index] = stats[f]
+
+def seasons_in(nc, attr='seasons'):
+    '''Snow seasons (year tags), or months (YYYY-MM) of daily output,
+       already accumulated into an open file.'''
+
+    return [s for s in nc.getncattr(attr).split(',') if s]
+
+def keys_in(nc, attr='seasons'):
+    '''Input keys (see result_cache.season_key) of the seasons or months
+       already accumulated into an open file, keyed by their tags.'''
+
+    if attr + '_keys' not in nc.ncattrs():
+        return {}
+
+    return json.loads(nc.getncattr(attr + '_keys'))
+
+def add_tag(nc, attr, tag, key):
+    '''Mark a season or month as accumulated from the inputs with key.'''
+
+    keys = keys_in(nc, attr)
+    keys[tag] = key
+
+    nc.setncattr(attr, ','.join(sorted(set(seasons_in(nc, attr) + [tag]))))
+    nc.setncattr(attr + '_keys', json.dumps(keys, sort_keys=True))
+
+def accumulated(nc, attr, tag, key):
+    '''Whether a season or month is already in an open file. Raises if it
+       was accumulated from different inputs, since its old values cannot
+       be taken out of the running statistics again.'''
+
+    if tag not in seasons_in(nc, attr):
+        return False
+
+    if keys_in(nc, attr).get(tag) != key:
+        raise ValueError(f'{tag} was accumulated into {nc.filepath()} from different inputs or model code; '
+                         'remove the file or set a new clim_worker to start a new climatology')
+
+    return True
+
+def check_grid(nc, lats, lons):
+    '''Raise if an open statistics file is not on the model grid.'''
+
+    if (nc.dimensions['lat'].size != lats.size) | (nc.dimensions['lon'].size != lons.size):
+        raise ValueError(f'{nc.filepath()} was accumulated on a different grid')
+
+def check_stats(fname, lats, lons, year_tag, season_key=None, month_keys=None):
+    '''Check before a run that its results can be added to the running
+       statistics, so that a mismatch is found before any output is
+       removed or computed.
+
+    Args:
+        fname (str): running statistics file
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        year_tag (str): snow season, YYYY_YYYY
+        season_key (str): input key of the season, None to skip the
+            annual statistics
+        month_keys (dict): input keys of the months to be added, keyed
+            by YYYY-MM
+    '''
+
+    if not exists(fname):
+        return
+
+    nc = Dataset(fname)
+    try:
+        check_grid(nc, lats, lons)
+        for month_tag, key in (month_keys or {}).items():
+            accumulated(nc, 'months', month_tag, key)
+        if season_key is not None:
+            accumulated(nc, 'seasons', year_tag, season_key)
+    finally:
+        nc.close()
+
+def open_stats(fname, lats, lons):
+    '''Open (creating if needed) a running statistics file for appending.'''
+
+    if not exists(fname):
+        create_stats_file(fname, lats, lons)
+
+    nc = Dataset(fname, 'a')
+    nc.set_auto_mask(False)
+
+    try:
+        check_grid(nc, lats, lons)
+    except ValueError:
+        nc.close()
+        raise
+
+    return nc
+
+def update_daily_stats(fname, lats, lons, year_tag, times, snf_record, key=''):
+    '''Add one month of daily snow depth to the day-of-season climatology.
+       Only the slots of that month are read and written. A month already
+       accumulated from the same inputs is skipped.
+
+    Args:
+        fname (str): running statistics file
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        year_tag (str): snow season, YYYY_YYYY
+        times (DatetimeIndex): days of the month
+        snf_record (ndarray): daily snow depth [m snow], shape (lat, lon, day)
+        key (str): input key of the month, see result_cache.month_keys
+    '''
+
+    nc = open_stats(fname, lats, lons)
+
+    month_tag = times[0].strftime('%Y-%m')
+    try:
+        done = accumulated(nc, 'months', month_tag, key)
+    except ValueError:
+        nc.close()
+        raise
+
+    if not done:
+        slots = [season_day(t.month, t.day) for t in times]
+        s0, s1 = slots[0], slots[-1] + 1
+
+        for j in range(0, lats.size, stats_band):
+            band = slice(j, j + stats_band)
+            stats = read_stats(nc, 'snow_depth', (slice(s0, s1), band))
+            for d in range(len(slots)):
+                day_stats = update_stats({f: stats[f][d] for f in stat_fields},
+                                         int(year_tag[:4]), snf_record[band,:,d])
+                for f in stat_fields:
+                    stats[f][d] = day_stats[f]
+            write_stats(nc, 'snow_depth', stats, (slice(s0, s1), band))
+        add_tag(nc, 'months', month_tag, key)
+
+    nc.close()
+
+def update_annual_stats(fname, lats, lons, year_tag, ptot_record, sftot_record, SWEmax_record, key=''):
+    '''Add the annual records of one season and mark the season as
+       accumulated, so that a rerun of the same season is not counted twice.
+       A rerun from different inputs raises instead, see accumulated.
+
+    Args:
+        fname (str): running statistics file
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        year_tag (str): snow season, YYYY_YYYY
+        ptot_record (ndarray): total precipitation [m]
+        sftot_record (ndarray): total snowfall [m water equivalent]
+        SWEmax_record (ndarray): maximum SWE [mm water equivalent]
+        key (str): input key of the season, see result_cache.season_key
+    '''
+
+    nc = open_stats(fname, lats, lons)
+
+    try:
+        done = accumulated(nc, 'seasons', year_tag, key)
+    except ValueError:
+        nc.close()
+        raise
+
+    if not done:
+        for v, record in zip(annual_vars, [ptot_record, sftot_record, SWEmax_record]):
+            for j in range(0, lats.size, stats_band):
+                band = slice(j, j + stats_band)
+                write_stats(nc, v, update_stats(read_stats(nc, v, band), int(year_tag[:4]), record[band]), band)
+        add_tag(nc, 'seasons', year_tag, key)
+
+    nc.close()
+
+def merge_stats_files(out_fname, fnames):
+    '''Merge running statistics files written by independent workers.
+
+    Args:
+        out_fname (str): merged file to write
+        fnames (list of str): files to merge, accumulated over disjoint seasons
+    '''
+
+    first = Dataset(fnames[0])
+    lats, lons = first['lat'][:], first['lon'][:]
+    first.close()
+
+    create_stats_file(out_fname, lats, lons)
+    out = open_stats(out_fname, lats, lons)
+
+    for fname in fnames:
+        nc = open_stats(fname, lats, lons)
+
+        overlap = ((set(seasons_in(nc)) & set(seasons_in(out)))
+                   | (set(seasons_in(nc, 'months')) & set(seasons_in(out, 'months'))))
+        if overlap:
+            nc.close()
+            out.close()
+            raise ValueError(f'{fname} repeats seasons already merged: {sorted(overlap)}')
+
+        for v in annual_vars:
+            write_stats(out, v, merge_stats(read_stats(out, v), read_stats(nc, v)))
+        for v in daily_vars:
+            for d in range(n_season_days): #one slot at a time to bound memory
+                write_stats(out, v, merge_stats(read_stats(out, v, d), read_stats(nc, v, d)), d)
+
+        for attr in ['seasons', 'months']:
+            for tag, key in keys_in(nc, attr).items():
+                add_tag(out, attr, tag, key)
+        nc.close()
+
+    out.close()
+
+def save_climatology(stats_fname, out_fname):
+    '''Write mean, standard deviation and trend of every variable. The
+       output is filled one band of rows (of one day slot) at a time to
+       bound memory.'''
+
+    nc = Dataset(stats_fname)
+    nc.set_auto_mask(False)
+    lats, lons = nc['lat'][:], nc['lon'][:]
+
+    out = Dataset(out_fname, 'w')
+    out.createDimension('day', n_season_days)
+    out.createDimension('lat', lats.size)
+    out.createDimension('lon', lons.size)
+
+    out.createVariable('lat', 'f8', ('lat',))[:] = lats
+    out.createVariable('lon', 'f8', ('lon',))[:] = lons
+    out.createVariable('day', 'i8', ('day',))[:] = np.arange(n_season_days)
+    out['lat'].setncatts({'long_name':'latitude', 'units':'degrees_north'})
+    out['lon'].setncatts({'long_name':'longitude', 'units':'degrees_east'})
+    out['day'].setncatts({'long_name':'day of snow season, Aug 1 = 0, Feb 29 = 212'})
+
+    band_chunk = (min(stats_band, lats.size), lons.size)
+    for v in annual_vars + daily_vars:
+        dims = ('lat', 'lon') if v in annual_vars else ('day', 'lat', 'lon')
+        chunks = band_chunk if v in annual_vars else (1,) + band_chunk
+        for f in ['mean', 'std', 'trend']:
+            out.createVariable(f'{v}_{f}', 'f8', dims, zlib=True, chunksizes=chunks, fill_value=np.nan)
+        out.createVariable(f'{v}_n', 'i4', dims, zlib=True, chunksizes=chunks)
+        out[f'{v}_trend'].description = 'least squares trend per year'
+        out[f'{v}_n'].description = 'number of seasons'
+
+        slots = [()] if v in annual_vars else [(d,) for d in range(n_season_days)]
+        for slot in slots:
+            for j in range(0, lats.size, stats_band):
+                index = slot + (slice(j, j + stats_band),)
+                stats = read_stats(nc, v, index)
+                for f, values in zip(['mean', 'std', 'trend'], finalize_stats(stats)):
+                    out[f'{v}_{f}'][index] = values
+                out[f'{v}_n'][index] = stats['n']
+
+    out.seasons = nc.seasons
+    out.close()
+    nc.close()
+    print('saved to netcdf:', out_fname)
+
+if __name__ == '__main__':
+    # python climatology.py merge merged.nc worker1.nc worker2.nc ...
+    # python climatology.py save merged.nc climatology.nc
+    if sys.argv[1] == 'merge':
+        merge_stats_files(sys.argv[2], sys.argv[3:])
+    elif sys.argv[1] == 'save':
+        save_climatology(sys.argv[2], sys.argv[3])
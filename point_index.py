@@ -0,0 +1,208 @@
+import sys
+from os.path import exists
+
+import numpy as np
+from netCDF4 import Dataset, num2date
+from pandas import Timestamp, DatetimeIndex, read_csv
+from xarray import open_dataset, Dataset as xrDataset, DataArray
+
+from utils import month_names_aug, monthly_out_name, points_name
+
+point_vars = ['snow_depth', 'density']
+
+# cells per chunk along lat and lon; each chunk holds the full season so a
+# point series is one contiguous read
+point_chunk = 8
+
+def season_tag(date):
+    '''Snow season (YYYY_YYYY) containing a date.'''
+
+    y = date.year if date.month >= 8 else date.year - 1
+
+    return str(y)+'_'+str(y+1)
+
+def build_point_store(Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Rewrite the 12 monthly output files of one season as a single
+       time-chunked file, so that the daily series of one cell can be read
+       without touching the rest of the grid. The grid is copied one band of
+       latitudes at a time to bound memory.
+
+    Args:
+        Unique_ID (str): tag used in the output filenames
+        output_loc (str): directory with the monthly output files
+        mixed_pr (list): mixed precipitation range, used in filenames
+        year_tag (str): snow season, YYYY_YYYY
+
+    Returns:
+        fname (str): point store filename
+    '''
+
+    months = [open_dataset(output_loc + monthly_out_name(Unique_ID, month, mixed_pr, year_tag))
+              for month in month_names_aug]
+
+    times = DatetimeIndex(np.concatenate([ds['time'].values for ds in months]))
+    lats, lons = months[0]['lat'].values, months[0]['lon'].values
+
+    fname = points_name(Unique_ID, output_loc, mixed_pr, year_tag)
+    nc = Dataset(fname, 'w')
+    nc.createDimension('time', times.size)
+    nc.createDimension('lat', lats.size)
+    nc.createDimension('lon', lons.size)
+
+    nc.createVariable('time', 'f8', ('time',))
+    nc['time'].units = 'days since ' + str(times[0].date())
+    nc['time'][:] = (times - times[0]).days
+    nc.createVariable('lat', 'f8', ('lat',))[:] = lats
+    nc.createVariable('lon', 'f8', ('lon',))[:] = lons
+    nc['lat'].setncatts({'long_name':'latitude', 'units':'degrees_north'})
+    nc['lon'].setncatts({'long_name':'longitude', 'units':'degrees_east'})
+
+    chunks = (times.size, min(point_chunk, lats.size), min(point_chunk, lons.size))
+    for v in point_vars:
+        nc.createVariable(v, 'f8', ('time', 'lat', 'lon'), chunksizes=chunks) #as in the monthly files
+        nc[v].setncatts({k: months[0][v].attrs[k] for k in ['description', 'units']})
+
+    for j in range(0, lats.size, point_chunk):
+        band = slice(j, j + point_chunk)
+        for v in point_vars:
+            nc[v][:, band, :] = np.concatenate([ds[v][:, band, :].values for ds in months])
+
+    nc.close()
+    for ds in months:
+        ds.close()
+    print('saved to netcdf:', fname)
+
+    return fname
+
+def nearest_cells(grid_lats, grid_lons, lats, lons):
+    '''Indices of the grid cells nearest to a list of points. The grid is
+       rectilinear, so the nearest latitude and longitude are found
+       separately by binary search on the sorted coordinates; longitudes
+       are compared modulo 360. A point is outside the model region if it
+       is more than half a grid spacing (the coarsest one of the grid)
+       from the nearest latitude or longitude; on a grid with a single
+       latitude or longitude only exact matches are inside.
+
+    Args:
+        grid_lats (ndarray): model latitudes
+        grid_lons (ndarray): model longitudes
+        lats (ndarray): point latitudes
+        lons (ndarray): point longitudes
+
+    Returns:
+        ilat (ndarray): latitude index of each point
+        ilon (ndarray): longitude index of each point
+        inside (ndarray): boolean, whether each point is in the model region
+    '''
+
+    def nearest(grid, x, period=None):
+        order = np.argsort(grid)
+        sgrid = grid[order]
+        if period is not None:
+            x = np.mod(x - sgrid[0], period) + sgrid[0]
+            sgrid = np.append(sgrid, sgrid[0] + period) #wrap around the seam
+            order = np.append(order, order[0])
+        spacing = np.max(np.diff(np.unique(grid)), initial=0.)
+        if sgrid.size == 1:
+            return order[np.zeros(x.shape, dtype='int')], x == sgrid[0]
+        k = np.clip(np.searchsorted(sgrid, x), 1, sgrid.size - 1)
+        k = np.where(np.abs(x - sgrid[k-1]) <= np.abs(sgrid[k] - x), k-1, k)
+        inside = np.abs(x - sgrid[k]) <= spacing / 2 + 1e-9
+        return order[k], inside
+
+    ilat, inlat = nearest(np.asarray(grid_lats, dtype='float64'), np.atleast_1d(lats))
+    ilon, inlon = nearest(np.asarray(grid_lons, dtype='float64'), np.atleast_1d(lons), period=360.)
+
+    return ilat, ilon, inlat & inlon
+
+def query_points(Unique_ID, output_loc, mixed_pr, lats, lons, start, end, station_ids=None):
+    '''Daily series of snow depth and density at a list of points, read
+       from the point stores of all seasons overlapping [start, end].
+
+    Args:
+        Unique_ID (str): tag used in the output filenames
+        output_loc (str): directory with the point stores
+        mixed_pr (list): mixed precipitation range, used in filenames
+        lats (ndarray): point latitudes
+        lons (ndarray): point longitudes
+        start (str or Timestamp): first day to return
+        end (str or Timestamp): last day to return
+        station_ids (list): optional names of the points
+
+    Returns:
+        output (Dataset): snow_depth and density with dims (station, time),
+            nan for points outside the model region
+    '''
+
+    start, end = Timestamp(start), Timestamp(end)
+    lats, lons = np.atleast_1d(lats), np.atleast_1d(lons)
+    if station_ids is None:
+        station_ids = np.arange(lats.size)
+
+    seasons = [str(y)+'_'+str(y+1) for y in range(int(season_tag(start)[:4]),
+                                                  int(season_tag(end)[:4]) + 1)]
+
+    series = {v: [] for v in point_vars}
+    times = []
+    for year_tag in seasons:
+        fname = points_name(Unique_ID, output_loc, mixed_pr, year_tag)
+        if not exists(fname):
+            raise FileNotFoundError(f'{fname} not found, run build_point_store for {year_tag}')
+
+        nc = Dataset(fname)
+        nc.set_auto_mask(False)
+
+        if year_tag == seasons[0]:
+            grid_lats, grid_lons = nc['lat'][:], nc['lon'][:]
+            ilat, ilon, inside = nearest_cells(grid_lats, grid_lons, lats, lons)
+            if not inside.all():
+                print('Outside the model region, returning nan:', list(np.asarray(station_ids)[~inside]))
+            cell_lats = np.where(inside, grid_lats[ilat], np.nan)
+            cell_lons = np.where(inside, grid_lons[ilon], np.nan)
+            # several points may share a cell; read each cell once
+            cells, inverse = np.unique(np.stack((ilat[inside], ilon[inside])), axis=1, return_inverse=True)
+
+        season_times = DatetimeIndex(num2date(nc['time'][:], nc['time'].units,
+                                              only_use_cftime_datetimes=False,
+                                              only_use_python_datetimes=True))
+        t0, t1 = season_times.searchsorted(start), season_times.searchsorted(end, side='right')
+        times.append(season_times[t0:t1])
+
+        for v in point_vars:
+            point_series = np.full((lats.size, t1 - t0), np.nan)
+            if inside.any():
+                cell_series = np.stack([nc[v][t0:t1, a, b] for a, b in cells.T])
+                point_series[inside] = cell_series[inverse.ravel()]
+            series[v].append(point_series)
+
+        nc.close()
+
+    output = xrDataset(
+        {v: DataArray(np.concatenate(series[v], axis=1), dims=['station', 'time'])
+         for v in point_vars},
+        coords={
+            'station': station_ids,
+            'time': np.concatenate(times),
+            'station_lat': (['station'], lats),
+            'station_lon': (['station'], lons),
+            'lat': (['station'], cell_lats),
+            'lon': (['station'], cell_lons),
+        }
+    )
+
+    return output
+
+if __name__ == '__main__':
+    # python point_index.py build Unique_ID output_loc YYYY_YYYY
+    # python point_index.py query Unique_ID output_loc stations.csv start end out.nc
+    #   (stations.csv has columns id, lat, lon)
+    Unique_ID, output_loc = sys.argv[2], sys.argv[3]
+    if sys.argv[1] == 'build':
+        build_point_store(Unique_ID, output_loc, [0,0], sys.argv[4])
+    elif sys.argv[1] == 'query':
+        stations = read_csv(sys.argv[4])
+        result = query_points(Unique_ID, output_loc, [0,0],
+                              stations['lat'].values, stations['lon'].values,
+                              sys.argv[5], sys.argv[6], station_ids=stations['id'].values)
+        result.to_netcdf(sys.argv[7])
+        print('saved to netcdf:', sys.argv[7])
@@ -0,0 +1,196 @@
+import hashlib
+import json
+from os import link, makedirs, remove, stat
+from os.path import dirname, exists, abspath, join
+from shutil import copy2
+
+from numpy import moveaxis
+from pandas import Timestamp
+from xarray import open_dataset
+
+from utils import month_names_aug, monthly_out_name, annual_out_name, points_name
+from point_index import build_point_store
+from climatology import update_daily_stats, update_annual_stats
+import time_step
+
+# modules whose code decides the cached output. CONFIG.py is left out, the
+# settings in it that change the output are keyed through result_settings
+model_sources = ['BTIM.py', 'BTIM_daily.py', 'run_day.py', 'time_step.py', 'utils.py',
+                 'square_mask.py', 'save_daily.py', 'save_annual.py', 'point_index.py']
+
+def model_version():
+    '''Hash of the model source code; any edit to it invalidates the cache.'''
+
+    h = hashlib.sha256()
+    for fname in model_sources:
+        h.update(fname.encode())
+        with open(join(dirname(abspath(__file__)), fname), 'rb') as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+def file_signature(fname, hash_contents=False):
+    '''Identify one forcing file by its size and modification time, or by
+       a hash of its contents.'''
+
+    if hash_contents:
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    st = stat(fname)
+
+    return [st.st_size, st.st_mtime_ns]
+
+def season_key(forcing_files, settings, hash_contents=False):
+    '''Cache key of one snow season.
+
+    Args:
+        forcing_files (list): temperature and precipitation filenames (or
+            lists of filenames) of the season
+        settings (dict): every CONFIG setting that changes the results
+        hash_contents (bool): whether to hash the forcing file contents
+            instead of their sizes and modification times
+
+    Returns:
+        key (str)
+    '''
+
+    flat_files = []
+    for f in forcing_files:
+        flat_files += f if isinstance(f, list) else [f]
+
+    key = {
+        'forcing_files': [[abspath(f), file_signature(f, hash_contents)] for f in flat_files],
+        'settings': settings,
+        'params': time_step.params,
+        'constants': time_step.constants,
+        'model_version': model_version(),
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def month_keys(t2m_files, tp_files, extra_files, settings, snow_season, months=range(12), hash_contents=False):
+    '''Keys of single months of a season, used to tell whether a month in
+       the climatology came from the same inputs.
+
+    Args:
+        t2m_files (list): temperature filenames of the season
+        tp_files (list): precipitation filenames of the season
+        extra_files (list): other input files, e.g. the land cover map
+        settings (dict): every CONFIG setting that changes the results
+        snow_season (list): [first year, second year]
+        months (list): months of the season to key, August = 0
+        hash_contents (bool): see season_key
+
+    Returns:
+        keys (dict): key of each month, keyed by YYYY-MM
+    '''
+
+    keys = {}
+    for i in months:
+        m = (i + 7) % 12 + 1
+        month_tag = Timestamp(snow_season[0] if m >= 8 else snow_season[1], m, 1).strftime('%Y-%m')
+        keys[month_tag] = season_key([t2m_files[i], tp_files[i]] + extra_files, settings, hash_contents)
+
+    return keys
+
+def season_files(Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Output files of one season, keyed by the name used in the cache.'''
+
+    files = {month+'.nc': output_loc + monthly_out_name(Unique_ID, month, mixed_pr, year_tag)
+             for month in month_names_aug}
+    files['annual.nc'] = output_loc + annual_out_name(Unique_ID, mixed_pr, year_tag)
+    files['points.nc'] = points_name(Unique_ID, output_loc, mixed_pr, year_tag)
+
+    return files
+
+def link_or_copy(src, dst):
+    '''Hard link src to dst, copying when the two are on different devices.'''
+
+    if exists(dst):
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+def unlink_season(Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Remove the output files of a season before it is run again. Restored
+       files are hard links into the cache, and writing over them in place
+       would change the cached copy too.'''
+
+    for fname in season_files(Unique_ID, output_loc, mixed_pr, year_tag).values():
+        if exists(fname):
+            remove(fname)
+
+def restore_season(cache_loc, key, Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Link the output of a cached season into output_loc.
+
+    Returns:
+        restored (bool): False if the season is not in the cache
+    '''
+
+    entry = join(cache_loc, key)
+    if not exists(join(entry, 'complete')):
+        return False
+
+    for cache_name, fname in season_files(Unique_ID, output_loc, mixed_pr, year_tag).items():
+        if exists(join(entry, cache_name)):
+            link_or_copy(join(entry, cache_name), fname)
+
+    print('Restored snow year ' + year_tag + ' from cache: ' + entry)
+
+    return True
+
+def store_season(cache_loc, key, Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Add the output of a finished season to the cache.'''
+
+    entry = join(cache_loc, key)
+    makedirs(entry, exist_ok=True)
+
+    for cache_name, fname in season_files(Unique_ID, output_loc, mixed_pr, year_tag).items():
+        if exists(fname):
+            link_or_copy(fname, join(entry, cache_name))
+
+    # written last, so that an interrupted store is never used
+    with open(join(entry, 'complete'), 'w') as f:
+        f.write(year_tag + '\n')
+
+def replay_season(Unique_ID, output_loc, mixed_pr, year_tag, clim_fname=None, point_store=False,
+                  clim_key='', clim_month_keys=None):
+    '''Bring a restored season into the climatology and build its point
+       store if the cache entry has none, as if it had just been run.
+
+    Args:
+        Unique_ID (str): tag used in the output filenames
+        output_loc (str): output directory
+        mixed_pr (list): mixed precipitation range
+        year_tag (str): snow season, YYYY_YYYY
+        clim_fname (str): running statistics file, None to skip
+        point_store (bool): whether the season needs a point store
+        clim_key (str): input key of the season, see season_key
+        clim_month_keys (dict): input keys of its months, see month_keys
+    '''
+
+    files = season_files(Unique_ID, output_loc, mixed_pr, year_tag)
+
+    if clim_fname is not None:
+        annual = open_dataset(files['annual.nc']).load()
+        lats, lons = annual['lat'].values, annual['lon'].values
+        for month in month_names_aug:
+            daily = open_dataset(files[month+'.nc']).load()
+            times = daily.indexes['time']
+            update_daily_stats(clim_fname, lats, lons, year_tag, times,
+                               moveaxis(daily['snow_depth'].values, 0, 2),
+                               clim_month_keys[times[0].strftime('%Y-%m')])
+            daily.close()
+        update_annual_stats(clim_fname, lats, lons, year_tag,
+                            annual['ptot'].values, annual['sftot'].values, annual['swemax'].values,
+                            clim_key)
+        annual.close()
+
+    if point_store & (not exists(files['points.nc'])):
+        build_point_store(Unique_ID, output_loc, mixed_pr, year_tag)
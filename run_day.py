@@ -0,0 +1,394 @@
+import numpy as np
+from pandas import Timestamp
+from xarray import Dataset, DataArray, open_dataset
+
+from utils import (month_names_aug, monthly_out_name, read_steps, read_land_cover, t2m_freq, tp_freq,
+                   standardize_precip, standardize_temp, len_month, read_month, mask_index)
+from square_mask import region_mask
+from time_step import Brasnett_day, land_cover_coefficients
+from save_daily import save_daily
+from save_annual import save_annual
+from climatology import update_daily_stats, update_annual_stats
+from point_index import build_point_store
+from tiling import tile_mask, choose_tiling, make_tiles
+
+def new_state(nlats, nlons, cellmask=None):
+    '''Prognostic variables and annual records at the start of a season.
+       Cells outside cellmask (see square_mask.region_mask) are not run
+       and stay nan.'''
+
+    state = {
+        'ptot_record': np.zeros((nlats, nlons)), #[m], total precip
+        'sftot_record': np.zeros((nlats, nlons)), #[m water equivalent], total snowfall
+        'SWEmax_record': np.zeros((nlats, nlons)), #[mm water equivalent], maximum SWE
+        'old_depth': np.zeros((nlats, nlons)), #[m snow depth]
+        'old_dens': np.zeros((nlats, nlons)), #[kg/m3]
+        't2m_air': None, #[K], last temperature read, None before the first step
+    }
+
+    if cellmask is not None:
+        for k in ['ptot_record', 'sftot_record', 'SWEmax_record', 'old_depth', 'old_dens']:
+            state[k][~cellmask] = np.nan
+
+    return state
+
+def load_cover(landcover_file, latmask, lonmask, cellmask=None):
+    '''Land cover coefficients of the model grid, computed once per run.
+
+    Args:
+        landcover_file (str): land cover map, see utils.read_land_cover;
+            None for open tundra everywhere
+        latmask (ndarray): boolean mask for region
+        lonmask (ndarray): boolean mask for region
+        cellmask (ndarray): cells of the region that are run, see
+            square_mask.region_mask
+
+    Returns:
+        cover (dict): see time_step.land_cover_coefficients
+    '''
+
+    if landcover_file is None:
+        icl = np.ones((np.sum(latmask), np.sum(lonmask)))
+        iopen = np.ones((np.sum(latmask), np.sum(lonmask)))
+    else:
+        icl, iopen = read_land_cover(landcover_file, latmask, lonmask, cellmask)
+
+    return land_cover_coefficients(icl, iopen)
+
+def run_day(state, forcing, mixed_pr, t2m, pr, day, latmask, lonmask, block=None, cover=None, cellmask=None):
+    '''Advance the snowpack through all forcing time steps of one day.
+
+    Args:
+        state (dict): prognostic variables and annual records, see new_state.
+            Updated in place.
+        forcing (str): name of forcing dataset
+        mixed_pr (list): mixed precipitation range
+        t2m (dataset): temperature data for the month, see read_month
+        pr (dataset): precipitation data for the month, see read_month
+        day (int): day of the month to run, starting from 0
+        latmask (ndarray): boolean mask for region
+        lonmask (ndarray): boolean mask for region
+        block (int): number of temperature time steps read from file and
+            passed to Brasnett_day at once, must divide t2m_freq[forcing]
+        cover (dict): land cover coefficients, see load_cover
+        cellmask (ndarray): cells of the region that are run, see
+            square_mask.region_mask; None to run every cell
+
+    Returns:
+        state (dict): the updated state
+    '''
+
+    if block is None:
+        block = t2m_freq[forcing]
+
+    # the physics only sees the cells that are run
+    cells = Ellipsis if cellmask is None else cellmask
+    if (cover is not None) & (cellmask is not None):
+        cover = {k: v[cells] for k, v in cover.items()}
+
+    nlats, nlons = state['old_depth'].shape
+    t2m_scale, tp_scale = np.ones((nlats, nlons)), np.ones((nlats, nlons))
+
+    t2m_steps_per_pr = t2m_freq[forcing] // tp_freq[forcing]
+    hours_per_step = 24 // t2m_freq[forcing]
+
+    for step0 in range(day * t2m_freq[forcing], (day + 1) * t2m_freq[forcing], block):
+        steps = np.arange(step0, step0 + block)
+
+        # ------- Read in a block of forcing data ------- #
+        t2m_block = read_steps(forcing, t2m, 't2m', step0, step0 + block, latmask, lonmask, cellmask)
+        pr_step0 = step0 // t2m_steps_per_pr
+        pr_block = read_steps(forcing, pr, 'tp', pr_step0,
+                              (step0 + block - 1) // t2m_steps_per_pr + 1, latmask, lonmask, cellmask)
+
+        # ------------ Precip per time step ------------- #
+        prate = (tp_scale * standardize_precip(forcing,
+                                               tp_freq[forcing],
+                                               t2m_freq[forcing],
+                                               pr_block[steps // t2m_steps_per_pr - pr_step0]))[:, cells] #[m water] per time step
+        prate[prate < 0] = 0
+
+        # ------------- Temperature series ------------- #
+        t2m_air = (t2m_scale * standardize_temp(forcing, t2m_block))[:, cells] #[K]
+        if state['t2m_air'] is None:
+            # initially use the same values for t2m_last as for t2m_air
+            t2m_last = t2m_air[0] #[K]
+            state['t2m_air'] = np.full((nlats, nlons), np.nan)
+        else:
+            t2m_last = state['t2m_air'][cells] #[K]
+        TSFC = np.asarray(np.concatenate((t2m_last[None], t2m_air))) - 273.15 #[degrees C]
+        state['t2m_air'][cells] = t2m_air[-1]
+        tavg = (TSFC[:-1] + TSFC[1:]) / 2 #[degrees C]
+
+        # -- Record precip, and snowfall where tavg < 0C -- #
+        ptot, sftot = state['ptot_record'][cells], state['sftot_record'][cells]
+        for s in range(block):
+            ptot += prate[s]
+            sftot[tavg[s] <= 0] += prate[s][tavg[s] <= 0]
+        state['ptot_record'][cells], state['sftot_record'][cells] = ptot, sftot
+
+        # ------- Time-step through the whole block ------- #
+        depth, dens, swemax = Brasnett_day(mixed_pr, TSFC, prate,
+                                           state['old_depth'][cells],
+                                           state['old_dens'][cells],
+                                           state['SWEmax_record'][cells],
+                                           hours_per_step,
+                                           cover=cover) #[m], [kg/m3], [mm]
+        state['old_depth'][cells], state['old_dens'][cells], state['SWEmax_record'][cells] = depth, dens, swemax
+
+    return state
+
+def run_day_tiled(state, forcing, mixed_pr, t2m, pr, day, latmask, lonmask, tiles, block=None, cover=None,
+                  cellmask=None):
+    '''Run one day tile by tile, see run_day and tiling.choose_tiling.
+       Tiles without any cell to run are skipped.
+
+    Args:
+        tiles (list of slice): bands of rows of the model grid
+    '''
+
+    if len(tiles) == 1:
+        return run_day(state, forcing, mixed_pr, t2m, pr, day, latmask, lonmask, block, cover, cellmask)
+
+    if state['t2m_air'] is None: #first step of the season, filled in tile by tile
+        state['t2m_air'] = np.full(state['old_depth'].shape, np.nan)
+        first_step = True
+    else:
+        first_step = False
+
+    for rows in tiles:
+        tile_cells = None if cellmask is None else cellmask[rows]
+        if (tile_cells is not None) and (not tile_cells.any()):
+            continue
+        tile_state = {k: v[rows] for k, v in state.items()}
+        if first_step:
+            tile_state['t2m_air'] = None
+        tile_cover = None if cover is None else {k: v[rows] for k, v in cover.items()}
+        tile_state = run_day(tile_state, forcing, mixed_pr, t2m, pr, day,
+                             tile_mask(latmask, rows), lonmask, block, tile_cover, tile_cells)
+        for k, v in tile_state.items():
+            state[k][rows] = v
+
+    return state
+
+def season_grid(forcing, t2m_files, tp_files, latminmax, region=None):
+    '''Model grid of a season, taken from the forcing files of its first month.
+
+    Args:
+        forcing (str): name of forcing dataset
+        t2m_files (list): temperature filenames of the season, see prepare_filenames
+        tp_files (list): precipitation filenames of the season
+        latminmax (list): latitude range, see CONFIG
+        region (list): boxes replacing latminmax, see CONFIG
+
+    Returns:
+        grid (dict): model latitudes and longitudes (lats, lons), the
+            boolean masks selecting them from the files (latmask, lonmask)
+            and the cells that are run (cellmask), see region_mask
+    '''
+
+    full_lat, full_lon, t2m, pr = read_month(8, forcing, t2m_files[0], tp_files[0])
+    pr.close()
+    t2m.close()
+
+    latmask, lonmask, cellmask = region_mask(full_lat, full_lon, latminmax, region)
+    lats, lons = full_lat[latmask], full_lon[mask_index(lonmask, wrap=True)]
+
+    if lats.size == 1:
+        lats, latmask = np.array([lats]), np.array([latmask])
+    if lons.size == 1:
+        lons, lonmask = np.array([lons]), np.array([lonmask])
+
+    return {'lats': lats, 'lons': lons, 'latmask': latmask, 'lonmask': lonmask, 'cellmask': cellmask}
+
+def run_season(grid, forcing, mixed_pr, t2m_files, tp_files, snow_season, leapdays=True,
+               max_mem=None, landcover_file=None, state=None, first_day=None, last_day=None,
+               climatology=False, point_store=False):
+    '''Step through a snow season, yielding the snowpack after every day.
+
+    Nothing is written to file; see BTIM.py for the consumer that writes the
+    monthly and annual output.
+
+    Args:
+        grid (dict): model grid, see season_grid
+        forcing (str): name of forcing dataset
+        mixed_pr (list): mixed precipitation range
+        t2m_files (list): temperature filenames of the season, see prepare_filenames
+        tp_files (list): precipitation filenames of the season
+        snow_season (list): [first year, second year]
+        leapdays (bool): whether to run February 29
+        max_mem (str): memory budget, see tiling.choose_tiling
+        landcover_file (str): land cover map, see load_cover
+        state (dict): state to continue from, see new_state; updated in
+            place. None starts the season from no snow
+        first_day (Timestamp): first day to run, August 1 if None
+        last_day (Timestamp): last day to run, July 31 if None
+        climatology (bool): whether the consumer adds months to the
+            climatology, memory for it is set aside, see tiling.choose_tiling
+        point_store (bool): whether the consumer builds the point store,
+            memory for it is set aside
+
+    Yields:
+        date (Timestamp), depth (ndarray), density (ndarray), swe (ndarray):
+            snow depth [m snow], density [kg/m3] and water equivalent [mm]
+            at the end of each day, shape (lat, lon), nan outside the
+            cells that are run. The arrays belong to
+            the model state and may be overwritten by the next day; copy
+            them to keep them.
+        annual (dict): after last_day, the annual records ptot_record,
+            sftot_record and SWEmax_record so far, see new_state
+    '''
+
+    nlats, nlons = grid['lats'].size, grid['lons'].size
+    latmask, lonmask, cellmask = grid['latmask'], grid['lonmask'], grid['cellmask']
+
+    # -- Split grid into tiles that fit the memory budget -- #
+    tile_rows, block = choose_tiling(max_mem, forcing, nlats, nlons, climatology, point_store)
+    tiles = make_tiles(nlats, tile_rows)
+
+    # -- Land cover coefficients, computed once -- #
+    cover = load_cover(landcover_file, latmask, lonmask, cellmask)
+
+    # -- Set up records and prognostic variables once -- #
+    if state is None:
+        state = new_state(nlats, nlons, cellmask)
+
+    if first_day is None:
+        first_day = Timestamp(snow_season[0], 8, 1)
+    if last_day is None:
+        last_day = Timestamp(snow_season[1], 7, 31)
+
+    for i, m in enumerate([8,9,10,11,12,1,2,3,4,5,6,7]):
+
+        current_y = snow_season[0]
+        if m < 8:
+            current_y = snow_season[1]
+
+        # -- Only the days from first_day to last_day are run -- #
+        days = [day for day in range(len_month(m, current_y, leapdays))
+                if first_day <= Timestamp(current_y, m, day + 1) <= last_day]
+        if not days:
+            continue
+
+        full_lat, full_lon, t2m, pr = read_month(m, forcing, t2m_files[i], tp_files[i])
+
+        try:
+            for day in days:
+                state = run_day_tiled(state, forcing, mixed_pr, t2m, pr, day, latmask, lonmask, tiles, block,
+                                      cover, cellmask)
+
+                yield (Timestamp(current_y, m, day + 1), state['old_depth'], state['old_dens'],
+                       state['old_depth'] * state['old_dens'])
+        finally:
+            pr.close()
+            t2m.close()
+
+    yield {k: state[k] for k in ['ptot_record', 'sftot_record', 'SWEmax_record']}
+
+def save_month(Unique_ID, output_loc, mixed_pr, year_tag, month_index, lats, lons,
+               times, snf_record, density_record, clim_fname=None, clim_key=''):
+    '''Write the daily records of a month and add them to the climatology.
+
+    Args:
+        Unique_ID (str): tag used in the output filenames
+        output_loc (str): output directory
+        mixed_pr (list): mixed precipitation range
+        year_tag (str): snow season, YYYY_YYYY
+        month_index (int): month of the season, August = 0
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        times (DatetimeIndex): days covered by the records
+        snf_record (ndarray): daily snow depth [m snow], shape (lat, lon, day)
+        density_record (ndarray): daily snow density [kg/m3]
+        clim_fname (str): running statistics file, None to skip
+        clim_key (str): input key of the month, see result_cache.month_keys
+    '''
+
+    #set up save name according to settings
+    out_fname = output_loc + monthly_out_name(Unique_ID,
+                                              month_names_aug[month_index],
+                                              mixed_pr,
+                                              year_tag)
+    save_daily(lats, lons, times,
+               snf_record, density_record,
+               out_fname)
+    if clim_fname is not None:
+        update_daily_stats(clim_fname, lats, lons, year_tag, times, snf_record, clim_key)
+
+def save_season(Unique_ID, output_loc, mixed_pr, year_tag, lats, lons, state,
+                first_time, last_time, clim_fname=None, point_store=False, clim_key=''):
+    '''Write the annual records of a season and everything derived from the
+       season's output.
+
+    Args:
+        Unique_ID (str): tag used in the output filenames
+        output_loc (str): output directory
+        mixed_pr (list): mixed precipitation range
+        year_tag (str): snow season, YYYY_YYYY
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        state (dict): annual records, see new_state and run_season
+        first_time (Timestamp): first day of the season
+        last_time (Timestamp): last day of the season
+        clim_fname (str): running statistics file, None to skip
+        point_store (bool): whether to build the point store of the season
+        clim_key (str): input key of the season, see result_cache.season_key
+    '''
+
+    save_annual(Unique_ID, output_loc, mixed_pr,
+                year_tag, lats, lons,
+                state['ptot_record'], state['sftot_record'], state['SWEmax_record'],
+                first_time, last_time)
+    if clim_fname is not None:
+        update_annual_stats(clim_fname, lats, lons, year_tag,
+                            state['ptot_record'], state['sftot_record'], state['SWEmax_record'],
+                            clim_key)
+    if point_store:
+        build_point_store(Unique_ID, output_loc, mixed_pr, year_tag)
+
+def save_state(fname, lats, lons, date, state, snf_record, density_record):
+    '''Persist the model state at the end of a day, together with the daily
+       records of the month so far.
+
+    Args:
+        fname (str): state filename
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        date (Timestamp): last day that was run
+        state (dict): prognostic variables and annual records, see new_state
+        snf_record (ndarray): daily snow depth of the month so far, shape
+            (lat, lon, day)
+        density_record (ndarray): daily snow density of the month so far
+    '''
+
+    grid = {'lat': (['lat'], lats), 'lon': (['lon'], lons)}
+
+    variables = {k: DataArray(v, dims=['lat', 'lon'], coords=grid) for k, v in state.items()}
+    variables['snf_record'] = DataArray(snf_record, dims=['lat', 'lon', 'day'], coords=grid)
+    variables['density_record'] = DataArray(density_record, dims=['lat', 'lon', 'day'], coords=grid)
+
+    dataset = Dataset(variables)
+    dataset.attrs['date'] = str(date.date())
+
+    dataset.to_netcdf(fname)
+    dataset.close()
+
+def load_state(fname):
+    '''Read a state written by save_state.
+
+    Returns:
+        lats (ndarray): model latitudes
+        lons (ndarray): model longitudes
+        date (Timestamp): last day that was run
+        state (dict): prognostic variables and annual records
+        snf_record (ndarray): daily snow depth of the month so far
+        density_record (ndarray): daily snow density of the month so far
+    '''
+
+    dataset = open_dataset(fname).load()
+    dataset.close()
+
+    state = {k: dataset[k].values for k in new_state(0, 0)}
+
+    return (dataset['lat'].values, dataset['lon'].values, Timestamp(dataset.attrs['date']),
+            state, dataset['snf_record'].values, dataset['density_record'].values)
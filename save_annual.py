@@ -1,5 +1,7 @@
 from xarray import Dataset, DataArray
 
+from utils import annual_out_name
+
 def save_annual(Unique_ID, output_loc, mixed_pr, year_tag, lats, lons, 
                 ptot_record, sftot_record, SWEmax_record, first_time, last_time):
     
@@ -57,9 +59,6 @@ def save_annual(Unique_ID, output_loc, mixed_pr, year_tag, lats, lons,
         
     output_dataset['time_bounds'] = DataArray([first_time, last_time], coords = {'nv':[0,1]}, dims = ['nv'])
 
-    savename = Unique_ID
-    if mixed_pr[0] != mixed_pr[1]:
-        savename += '.mixedpr'
-    output_dataset.to_netcdf(output_loc + f'{savename}.annual.{year_tag}.nc')
+    output_dataset.to_netcdf(output_loc + annual_out_name(Unique_ID, mixed_pr, year_tag))
     
     output_dataset.close()
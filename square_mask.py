@@ -1,8 +1,71 @@
+import numpy as np
+
+from utils import mask_index
+
 def square_mask(full_lat, full_lon, latminmax):
     
     # mask for latitudes
     lat_mask = (full_lat >= latminmax[0]) & (full_lat <= latminmax[1])
     
     return lat_mask
-                
-       
+
+def box_mask(full_lat, full_lon, box):
+    '''Latitude and longitude masks for one box [lat_min, lat_max, lon_min, lon_max].
+       Longitudes are compared modulo 360, so either the 0/360 or the -180/180
+       convention may be used for the box and the file. A box with
+       lon_min > lon_max crosses the seam, e.g. [50, 75, 170, -130].'''
+
+    lat_min, lat_max, lon_min, lon_max = box
+
+    lat_mask = (full_lat >= lat_min) & (full_lat <= lat_max)
+
+    if lon_max - lon_min >= 360:
+        lon_mask = np.ones_like(full_lon, dtype='bool')
+    else:
+        lon_mask = np.mod(full_lon - lon_min, 360) <= np.mod(lon_max - lon_min, 360)
+
+    return lat_mask, lon_mask
+
+def region_mask(full_lat, full_lon, latminmax, region=None):
+    '''Latitude and longitude masks of the model grid.
+    
+    Args:
+        full_lat (ndarray): latitudes in forcing files
+        full_lon (ndarray): longitudes in forcing files
+        latminmax (list): latitude range used when region is None
+        region (list): boxes [lat_min, lat_max, lon_min, lon_max]. The grid 
+            covers the union of their latitudes times the union of their 
+            longitudes.
+        
+    Returns:
+        lat_mask (ndarray): boolean mask over full_lat
+        lon_mask (ndarray): boolean mask over full_lon
+        cell_mask (ndarray): boolean mask over the model grid (lat, lon) of
+            the cells inside a box, None if all of them are. Cells outside
+            every box are neither read nor run.
+    '''
+    
+    if region is None:
+        return square_mask(full_lat, full_lon, latminmax), np.ones_like(full_lon, dtype='bool'), None
+    
+    boxes = [box_mask(full_lat, full_lon, box) for box in region]
+    for box, (box_lat, box_lon) in zip(region, boxes):
+        if not (box_lat.any() and box_lon.any()):
+            raise ValueError(f'region box {box} contains no grid cell of the forcing files')
+    
+    lat_mask = np.zeros_like(full_lat, dtype='bool')
+    lon_mask = np.zeros_like(full_lon, dtype='bool')
+    for box_lat, box_lon in boxes:
+        lat_mask |= box_lat
+        lon_mask |= box_lon
+    
+    # model grid order, see utils.mask_index
+    lon_index = mask_index(lon_mask, wrap=True)
+    cell_mask = np.zeros((np.sum(lat_mask), np.sum(lon_mask)), dtype='bool')
+    for box_lat, box_lon in boxes:
+        cell_mask |= box_lat[lat_mask][:,None] & box_lon[lon_index][None,:]
+    
+    if cell_mask.all():
+        cell_mask = None
+    
+    return lat_mask, lon_mask, cell_mask
@@ -0,0 +1,130 @@
+import numpy as np
+
+from utils import t2m_freq, tp_freq
+from climatology import stats_band
+from point_index import point_chunk
+
+# approximate bytes per grid cell, measured with tracemalloc
+# arrays kept for the whole run: prognostic variables, annual records and
+# the daily records of one month (plus the copy made when saving them),
+# and the land cover coefficients
+fixed_cell_bytes = 8 * (6 + 4 * 31 + 5)
+# peak of temporaries in Brasnett_day / hour_step for one forcing time
+# step, not counting the interpolated hourly temperatures
+step_cell_bytes = 260
+# per forcing value read from file: float32 data and mask
+read_cell_bytes = 4 + 1
+# per time step in a block: float64 temperature, precipitation and
+# snowfall series passed to Brasnett_day
+block_cell_bytes = 8 * 6
+# peak while a month is added to the climatology, per cell of one band of
+# climatology.stats_band rows; this happens between days, never while a
+# tile is stepped
+clim_cell_bytes = 3100
+# peak while the point store is built at the end of the season, per cell of
+# one band of point_index.point_chunk rows: the daily series of the band
+# read from the monthly files and joined
+point_cell_bytes = 6400
+
+units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_memory(text):
+    '''Convert a memory size such as "8G", "512M" or "1.5T" to bytes.'''
+
+    text = str(text).strip().upper().rstrip('B')
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+
+    return int(float(text))
+
+def tile_cell_bytes(forcing, block):
+    '''Working memory per grid cell of a tile while it is stepped.
+
+    Args:
+        forcing (str): name of forcing dataset
+        block (int): number of temperature time steps read at once
+
+    Returns:
+        nbytes (int)
+    '''
+
+    hours_per_step = 24 // t2m_freq[forcing]
+    pr_block = -(-block * tp_freq[forcing] // t2m_freq[forcing])
+
+    T_hr_bytes = 8 * (hours_per_step + 1)
+
+    return (step_cell_bytes + T_hr_bytes + read_cell_bytes * (block + pr_block)
+            + block_cell_bytes * block)
+
+def choose_tiling(max_mem, forcing, nlats, nlons, climatology=False, point_store=False):
+    '''Pick the number of grid rows stepped together and the number of
+       forcing time steps read at once so that the estimated peak memory
+       stays below max_mem. The whole grid is preferred over reading many
+       steps at once, since every extra tile repeats the per-step overhead.
+
+    Args:
+        max_mem (str or int): memory budget, e.g. "8G"; None for no budget
+        forcing (str): name of forcing dataset
+        nlats (int): number of model latitudes
+        nlons (int): number of model longitudes
+        climatology (bool): whether months are added to the climatology
+            between days
+        point_store (bool): whether the point store is built after the
+            last day
+
+    Returns:
+        tile_rows (int): number of grid rows per tile
+        block (int): number of temperature time steps read at once
+    '''
+
+    if max_mem is None:
+        return nlats, t2m_freq[forcing]
+
+    budget = parse_memory(max_mem)
+    available = budget - fixed_cell_bytes * nlats * nlons
+
+    # memory needed between days by the enabled consumers of the output
+    reserve = 0
+    if climatology:
+        reserve = max(reserve, clim_cell_bytes * min(stats_band, nlats) * nlons)
+    if point_store:
+        reserve = max(reserve, point_cell_bytes * min(point_chunk, nlats) * nlons)
+
+    blocks = [b for b in range(t2m_freq[forcing], 0, -1) if t2m_freq[forcing] % b == 0]
+    for block in blocks:
+        tile_rows = available // (tile_cell_bytes(forcing, block) * nlons)
+        if tile_rows >= nlats:
+            tile_rows = nlats
+            break
+
+    if (tile_rows < 1) | (available < reserve):
+        needed = fixed_cell_bytes * nlats * nlons + max(tile_cell_bytes(forcing, 1) * nlons, reserve)
+        raise MemoryError(f'max_mem {max_mem} is too small for a {nlats}x{nlons} grid, '
+                          f'at least {needed} bytes are needed')
+
+    print(f'Memory budget {max_mem}: {int(tile_rows)} of {nlats} rows per tile, '
+          f'{block} forcing steps per read, estimated peak '
+          f'{(fixed_cell_bytes * nlats * nlons + max(tile_cell_bytes(forcing, block) * tile_rows * nlons, reserve)) / units["M"]:.1f}M')
+
+    return int(tile_rows), block
+
+def make_tiles(nlats, tile_rows):
+    '''Split the rows of the model grid into bands of at most tile_rows.'''
+
+    return [slice(j, min(j + tile_rows, nlats)) for j in range(0, nlats, tile_rows)]
+
+def tile_mask(latmask, rows):
+    '''Restrict a latitude mask to the rows of one tile.
+
+    Args:
+        latmask (ndarray): boolean mask for region, over the file latitudes
+        rows (slice): rows of the model grid, i.e. of the selected latitudes
+
+    Returns:
+        mask (ndarray): boolean mask over the file latitudes
+    '''
+
+    mask = np.zeros_like(latmask)
+    mask[np.flatnonzero(latmask)[rows]] = True
+
+    return mask
@@ -44,7 +44,20 @@ def warm_snow_aging(DENSITY, DEPTH, timestep, warm_settle_mask):
 
     return del_den_warm
 
-def cold_snow_aging(DENSITY, DEPTH, TDD, icl, cold_settle_mask):
+def cold_aging_coefficient(icl):
+    '''
+    Densification coefficient C2 of cold snow aging [m3/kg].
+
+    Args:
+        icl (ndarray): land cover classification, see land_cover_coefficients
+
+    Returns:
+        C2 (ndarray): array of the same size as icl
+    '''
+
+    return np.where((icl == 2) | (icl == 6), 28./1000., 21./1000.)
+
+def cold_snow_aging(DENSITY, DEPTH, TDD, C2, cold_settle_mask):
     '''
     Density change over timestep when temperature is below T_melt.
     
@@ -52,8 +65,8 @@ def cold_snow_aging(DENSITY, DEPTH, TDD, icl, cold_settle_mask):
         DENSITY (ndarray): current snow density [kg/m3]
         DEPTH (ndarray): current snow depth (m snow)
         TDD (ndarray): current temperature minus T_melt
-        icl (ndarray): land cover classification of same 
-            size as above arrays
+        C2 (ndarray): densification coefficient of same size as 
+            above arrays, see cold_aging_coefficient
         cold_settle_mask (ndarray): boolean mask of the same size 
             as DENSITY and SWE denoting where cold snow aging should 
             occur.
@@ -64,7 +77,6 @@ def cold_snow_aging(DENSITY, DEPTH, TDD, icl, cold_settle_mask):
     '''
 
     C1 = 2.
-    C2 = np.where((icl == 2) | (icl == 6), 28./1000., 21./1000.)
     C3 = 0.08
     B1 = 0.6
     
@@ -138,38 +150,60 @@ def new_snow_density(hT):
     
     return np.atleast_1d(rhosfall)
 
-def daily_melt_rate(DENSITY, boreal_mask):
-    ''' 
+def land_cover_coefficients(icl, iopen, tundraprairie_scaling=0.8, boreal_scaling=0.8):
+    '''
+    Coefficients that depend only on land cover, computed once per run so 
+    that the hourly physics does not rebuild them.
+
+    Args:
+        icl (ndarray): land cover classification (1: tundra, 2: boreal 
+            forest, 5: prairie, 6: denser cold settling as for 2)
+        iopen (ndarray): 1 where the land is open, 0 under forest canopy.
+            Same size as icl.
+        tundraprairie_scaling (float): see reduce_precip
+        boreal_scaling (float): see reduce_precip
+
+    Returns:
+        cover (dict): arrays of the same size as icl
+            C2: cold snow aging coefficient, see cold_snow_aging
+            melt_slope, melt_offset, melt_max: daily melt rate as a 
+                function of density, see cover_melt_rate
+            precip_scale: precipitation scaling, see reduce_precip
+    '''
+
+    boreal_mask = (icl == 2) & (iopen == 0)
+    tundraprairie_mask = (icl == 1) | (icl == 5)
+
+    cover = {
+        'C2': cold_aging_coefficient(icl),
+        'melt_slope': np.where(boreal_mask, 5.2e-3, 9.8e-3), #[mm w.e./dayK per kg/m3]
+        'melt_offset': np.where(boreal_mask, -0.7, -2.39), #[mm w.e./dayK]
+        'melt_max': np.where(boreal_mask, 3.5, 5.5), #[mm w.e./dayK]
+        'precip_scale': reduce_precip(np.ones(np.shape(icl)),
+                                      tundraprairie_scaling, tundraprairie_mask,
+                                      boreal_scaling, boreal_mask),
+    }
+
+    return cover
+
+def cover_melt_rate(DENSITY, cover):
+    '''
     Daily melt rate for snow based on existing snow density 
-    and vegetation type. Based on Kuusito (1980).
+    and vegetation type, following Kuusisto (1980): a linear function of
+    density, bounded below by 0.1 and above by 5.5 (3.5 for boreal forest
+    under canopy), with coefficients from land_cover_coefficients.
 
     Args:
         DENSITY (ndarray): current density of snow [kg/m3].
-        boreal_mask (ndarray): boolean array of the same size as DENSITY
-            denoting regions which are classified as boreal forest land
-            type.
+        cover (dict): see land_cover_coefficients
 
     Returns:
-        dd (ndarray): hourly melt rate [mm w.e. / hr.day] of snowpack.
+        dd (ndarray): daily melt rate [mm w.e. / dayK] of snowpack.
     '''
-    
-    ### find gamma, hourly melt rate. depends on density 
-        #and vegetation type following Kuusisto (1980)
 
-    dd = (9.8e-3 * DENSITY) - 2.39 #daily melt [mm w.e./dayK]
-    dd[dd < 0.1] = 0.1
-    dd[dd > 5.5] = 5.5
+    dd = (cover['melt_slope'] * DENSITY) + cover['melt_offset'] #[mm w.e./dayK]
 
-    ### AEC 2023: we're treating all points as Tundra  ###
-    ### so this section is basically ignored           ###
-    boreal = (5.2e-3 * DENSITY) - 0.7 #[mm w.e./dayK]
-    boreal[boreal < 0.1] = 0.1
-    boreal[boreal > 3.5] = 3.5
-    ### ---------------------------------------------- ###
-    
-    dd = np.where(boreal_mask, boreal, dd) #merge dd and boreal
-
-    return dd #melt in [mm w.e./ hr day]
+    return np.minimum(np.maximum(dd, 0.1), cover['melt_max'])
 
 def reduce_precip(hP, tundraprairie_scaling, tundraprairie_mask, boreal_scaling, boreal_mask):
     '''
@@ -198,7 +232,7 @@ def reduce_precip(hP, tundraprairie_scaling, tundraprairie_mask, boreal_scaling,
    
     return hP
 
-def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=False):
+def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=False, C2=None):
     '''
     Update snow density given preceipitation and temperature
     during time step.
@@ -219,6 +253,8 @@ def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=Fal
         hP (ndarray): hourly precipitation (mm w.e.)
         DENSITY: existing snow density (kg/m^3)
         DEPTH: existing snow depth (m snow)
+        C2 (ndarray): cold snow aging coefficient from land_cover_coefficients,
+            defaults to all points being tundra
 
     Returns:
         DEPTH (ndarray): updated depth, array of same size as hT and hP
@@ -231,8 +267,8 @@ def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=Fal
     T_switch_upper, T_switch_lower = mixed_pr_range
     mixed_range = T_switch_upper - T_switch_lower
     
-    iopen = np.ones_like(DENSITY)
-    icl = np.ones_like(DENSITY)
+    if C2 is None: #open tundra
+        C2 = cold_aging_coefficient(np.ones_like(DENSITY))
     
     ### determine precipitation phase at grid squares
     phase = np.where(hT <= params['Tfreeze'], 1., 0.) #snow: phase = 1, rain: phase = 0
@@ -300,7 +336,7 @@ def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=Fal
     btim_tdelt = 3600 #1h [s]
     del_DENSITY_warm = warm_snow_aging(DENSITY, DEPTH, btim_tdelt * weight, warm_settle_mask)
     
-    del_DENSITY_cold = weight * cold_snow_aging(DENSITY, DEPTH, np.atleast_1d(hT - params['Tmelt']), icl, cold_settle_mask)
+    del_DENSITY_cold = weight * cold_snow_aging(DENSITY, DEPTH, np.atleast_1d(hT - params['Tmelt']), C2, cold_settle_mask)
 
     del_DENSITY = np.zeros_like(DENSITY)
 
@@ -318,7 +354,7 @@ def hour_step(weight, mixed_pr_range, hG, hT, hP, DENSITY, DEPTH, debug_mode=Fal
     
     return DENSITY, DEPTH
 
-def Brasnett(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY, tundraprairie_scaling=0.8, boreal_scaling=0.8, debug_mode=False):
+def Brasnett(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY, tundraprairie_scaling=0.8, boreal_scaling=0.8, debug_mode=False, cover=None):
     '''
     Empirical algorithm to melt snow according to the surface temperature and 
     increase snow depth according to the precipitation that has fallen since 
@@ -331,13 +367,41 @@ def Brasnett(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY,
         HOURLY_PRECIP (float): total precipitation [m water] occurring per hour during time step
         SNOW_DEPTH (float): snow depth field [m] at the beginning of the time step.
         SNOW_DENSITY (float): density field at the beginning of the time step [kg/m^3]
+        cover (dict): land cover coefficients from land_cover_coefficients, 
+            defaults to all points being open tundra
     '''     
     
-    iopen = np.ones_like(SNOW_DEPTH)
-    icl = np.ones_like(SNOW_DEPTH)
+    if cover is None:
+        cover = land_cover_coefficients(np.ones_like(SNOW_DEPTH), np.ones_like(SNOW_DEPTH),
+                                        tundraprairie_scaling, boreal_scaling)
+
+    ### adjust precipitation
+    HOURLY_PRECIP = np.asarray(HOURLY_PRECIP) * cover['precip_scale']
+    
+    return forcing_step(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY, 
+                        cover, debug_mode=debug_mode)
+
+def forcing_step(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY, cover, debug_mode=False):
+    '''
+    Advance the snowpack through the hours of one forcing time step. Shared by
+    Brasnett and Brasnett_day, which set up the land cover coefficients and 
+    the precipitation reduction.
+    
+    Args:
+        HOURLY_T (floats): ndarray of shape (nhours+1, lat, lon) containing the temperature 
+            [degree C] every hour during the time step
+        HOURLY_PRECIP (float): reduced precipitation [m water] occurring per hour during time step
+        SNOW_DEPTH (float): snow depth field [m] at the beginning of the time step.
+        SNOW_DENSITY (float): density field at the beginning of the time step [kg/m^3]
+        cover (dict): land cover coefficients, see land_cover_coefficients
+
+    Returns:
+        SNOW_DEPTH (ndarray): snow depth [m] at the end of the time step
+        SNOW_DENSITY (ndarray): density [kg/m^3] at the end of the time step
+        NEW_SWE (ndarray): snow water equivalent [mm] at the end of the time step
+    '''
     
     T_switch_upper, T_switch_lower = mixed_pr_range
-    mixed_range = T_switch_upper - T_switch_lower
     
     SNOW_DENSITY = np.maximum(params['rhomin'], np.minimum(params['rhomax'], SNOW_DENSITY)) #[kg/m^3]
     
@@ -345,28 +409,20 @@ def Brasnett(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY,
     no_chance_mask = (HOURLY_T[0,...] > T_switch_upper) & (HOURLY_T[-1,...] > T_switch_upper) & (SNOW_DEPTH <= 0)
 
     ### calculate melt rates
-    boreal_mask = (icl == 2) & (iopen == 0)  
-    tundraprairie_mask = (icl == 1) | (icl == 5)
-
-    HOURLY_GAMMA = daily_melt_rate(SNOW_DENSITY, boreal_mask) / 24 #[mm/hrK]
-
-    ### adjust precipitation
-    HOURLY_PRECIP = reduce_precip(HOURLY_PRECIP, 
-                                  tundraprairie_scaling, tundraprairie_mask,
-                                  boreal_scaling, boreal_mask)
+    HOURLY_GAMMA = cover_melt_rate(SNOW_DENSITY, cover) / 24 #[mm/hrK]
     
     ### beyond this point, SNOW_DEPTH and SNOW_DENSITY will be updated for each hour in the 
         #model time step based on temperature and precipitation
     SNOW_DENSITY, SNOW_DEPTH = hour_step(0.5, mixed_pr_range, HOURLY_GAMMA, 
                                          np.atleast_1d(HOURLY_T[0,...]), HOURLY_PRECIP, SNOW_DENSITY, SNOW_DEPTH,
-                                         debug_mode=debug_mode)
+                                         debug_mode=debug_mode, C2=cover['C2'])
     for i in range(1, np.shape(HOURLY_T)[0]-1):
         SNOW_DENSITY, SNOW_DEPTH = hour_step(1, mixed_pr_range, HOURLY_GAMMA, 
                                              np.atleast_1d(HOURLY_T[i,...]), HOURLY_PRECIP, SNOW_DENSITY, SNOW_DEPTH,
-                                             debug_mode=debug_mode)
+                                             debug_mode=debug_mode, C2=cover['C2'])
     SNOW_DENSITY, SNOW_DEPTH = hour_step(0.5, mixed_pr_range, HOURLY_GAMMA, 
                                          np.atleast_1d(HOURLY_T[-1,...]), HOURLY_PRECIP, SNOW_DENSITY, SNOW_DEPTH, 
-                                         debug_mode=debug_mode)
+                                         debug_mode=debug_mode, C2=cover['C2'])
     
     ### save final value after model time step
     SNOW_DEPTH = np.minimum(SNOW_DEPTH, params['sdep_max']) #depth does not exceed 6m
@@ -377,3 +433,50 @@ def Brasnett(mixed_pr_range, HOURLY_T, HOURLY_PRECIP, SNOW_DEPTH, SNOW_DENSITY,
     NEW_SWE = SNOW_DEPTH * SNOW_DENSITY #[mm water], snowpack water equivalent
     
     return SNOW_DEPTH, SNOW_DENSITY, NEW_SWE
+
+def Brasnett_day(mixed_pr_range, STEP_T, STEP_PRECIP, SNOW_DEPTH, SNOW_DENSITY, SWE_MAX, hours_per_step, tundraprairie_scaling=0.8, boreal_scaling=0.8, debug_mode=False, cover=None):
+    '''
+    Brasnett for a block of consecutive forcing time steps, usually one day, 
+    in a single call. The hourly precipitation is set up once for the block; 
+    the results are the same as calling Brasnett once per time step.
+    
+    Args:
+        STEP_T (floats): ndarray of shape (nsteps+1, lat, lon) containing the temperature
+            [degree C] at the end of the previous time step followed by the end of each
+            time step in the block.
+        STEP_PRECIP (floats): ndarray of shape (nsteps, lat, lon) with the total 
+            precipitation [m water] of each time step
+        SNOW_DEPTH (float): snow depth field [m] at the beginning of the block.
+        SNOW_DENSITY (float): density field at the beginning of the block [kg/m^3]
+        SWE_MAX (float): running maximum of SWE [mm water] before the block
+        hours_per_step (int): length of one forcing time step [hours]
+        cover (dict): land cover coefficients from land_cover_coefficients, 
+            defaults to all points being open tundra
+
+    Returns:
+        SNOW_DEPTH (ndarray): snow depth [m] at the end of the block
+        SNOW_DENSITY (ndarray): density [kg/m^3] at the end of the block
+        SWE_MAX (ndarray): running maximum of SWE [mm water] after the block
+    '''
+    
+    if cover is None:
+        cover = land_cover_coefficients(np.ones_like(SNOW_DEPTH), np.ones_like(SNOW_DEPTH),
+                                        tundraprairie_scaling, boreal_scaling)
+    
+    ### hourly precipitation for every time step at once
+    HOURLY_PRECIP = np.asarray(STEP_PRECIP / hours_per_step) * cover['precip_scale'] #[m] in one hour
+    
+    hr = np.arange(hours_per_step+1).reshape((-1,) + (1,) * np.ndim(SNOW_DEPTH)) #broadcast over the grid
+    
+    for s in range(np.shape(STEP_PRECIP)[0]):
+        
+        ### linearly interpolate temperature within the time step
+        HOURLY_T = (STEP_T[s+1,...] - STEP_T[s,...]) * hr / hours_per_step + STEP_T[s,...] #[degrees C]
+        
+        SNOW_DEPTH, SNOW_DENSITY, NEW_SWE = forcing_step(mixed_pr_range, HOURLY_T, HOURLY_PRECIP[s,...], 
+                                                         SNOW_DEPTH, SNOW_DENSITY, cover, 
+                                                         debug_mode=debug_mode)
+        
+        SWE_MAX = np.maximum(SWE_MAX, NEW_SWE) #[mm water]
+    
+    return SNOW_DEPTH, SNOW_DENSITY, SWE_MAX
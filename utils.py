@@ -1,4 +1,5 @@
-from numpy import isin
+from numpy import isin, flatnonzero, diff, split, concatenate, empty
+from numpy.ma import concatenate as ma_concatenate, filled, masked_all
 from os import listdir
 from netCDF4 import Dataset
 from xarray import open_mfdataset
@@ -113,43 +114,136 @@ def read_month(month, forcing, t2m_fname, tp_fname):
     
     return full_lat, full_lon, t2m, tp
 
-def read_day(forcing, data, forcing_var, step, latmask, lonmask):
-    '''Extracts forcing data for just one time step and region.
+def mask_runs(mask, wrap=False):
+    '''Contiguous runs of a boolean mask as slices, so that a region can be
+       read as a few hyperslabs instead of point by point.
+    
+    Args:
+        mask (ndarray): boolean mask for region
+        wrap (bool): whether the dimension is periodic (longitude). A region
+            touching both ends of the dimension crosses the seam; its last
+            run is then moved to the front so the region stays contiguous.
+        
+    Returns:
+        runs (list of slice): in the order the region is laid out
+    '''
+    
+    index = flatnonzero(mask)
+    if index.size == 0:
+        return []
+    
+    runs = [slice(r[0], r[-1]+1) for r in split(index, flatnonzero(diff(index) > 1) + 1)]
+    
+    if wrap & (len(runs) > 1) & (index[0] == 0) & (index[-1] == mask.size-1):
+        runs = runs[-1:] + runs[:-1]
+    
+    return runs
+
+def mask_index(mask, wrap=False):
+    '''Indices selected by a mask, in the order the region is laid out.'''
+    
+    return concatenate([range(r.start, r.stop) for r in mask_runs(mask, wrap)]).astype('int')
+
+def read_region(var, steps, latmask, lonmask, values=False, cellmask=None):
+    '''Reads only the hyperslabs covering a region and joins them.
+    
+    Args:
+        var (variable): netCDF4 or xarray variable with dims (time, lat, lon)
+        steps (slice): time steps to extract
+        latmask (ndarray): boolean mask for region
+        lonmask (ndarray): boolean mask for region
+        values (bool): whether var is an xarray variable
+        cellmask (ndarray): cells of the region to read, see 
+            square_mask.region_mask; hyperslabs without any are not read
+            and are masked in the output
+        
+    Returns:
+        output (ndarray)
+    '''
+    
+    def read(la, lo, j, i):
+        if (cellmask is not None) and (not cellmask[j:j+la.stop-la.start, i:i+lo.stop-lo.start].any()):
+            return masked_all(empty(var.shape[:-2])[steps].shape + (la.stop-la.start, lo.stop-lo.start), 
+                              dtype=var.dtype)
+        return var[steps,la,lo].values if values else var[steps,la,lo]
+    
+    lon_runs = mask_runs(lonmask, wrap=True)
+    lon_starts = concatenate([[0], [lo.stop-lo.start for lo in lon_runs]]).cumsum()
+    
+    rows = []
+    j = 0
+    for la in mask_runs(latmask):
+        slabs = [read(la, lo, j, i) for lo, i in zip(lon_runs, lon_starts)]
+        rows.append(slabs[0] if len(slabs) == 1 else ma_concatenate(slabs, axis=-1))
+        j += la.stop - la.start
+    
+    return rows[0] if len(rows) == 1 else ma_concatenate(rows, axis=-2)
+
+def read_land_cover(fname, latmask, lonmask, cellmask=None):
+    '''Reads the land cover classification of a region.
+    
+    Args:
+        fname (str): netCDF file with variables icl and iopen on the 
+            (lat, lon) grid of the forcing files
+        latmask (ndarray): boolean mask for region
+        lonmask (ndarray): boolean mask for region
+        cellmask (ndarray): cells of the region to read, see read_region
+        
+    Returns:
+        icl (ndarray): land cover class, see time_step.land_cover_coefficients
+        iopen (ndarray): 1 for open land, 0 under forest canopy
+    '''
+    
+    with Dataset(fname) as data:
+        for v in ['icl', 'iopen']:
+            if data[v].shape != (latmask.size, lonmask.size):
+                raise ValueError(f'{v} in {fname} has shape {data[v].shape}, the forcing grid is '
+                                 f'{(latmask.size, lonmask.size)}')
+        icl = read_region(data['icl'], Ellipsis, latmask, lonmask, cellmask=cellmask)
+        iopen = read_region(data['iopen'], Ellipsis, latmask, lonmask, cellmask=cellmask)
+    
+    return filled(icl, 1), filled(iopen, 1) #missing cells as open tundra
+
+def read_steps(forcing, data, forcing_var, step0, step1, latmask, lonmask, cellmask=None):
+    '''Extracts forcing data for a block of consecutive time steps and region.
     
     Args:
         forcing (str): name of forcing dataset
         data (dataset)
         forcing_var (str): name of variable
-        step (int): time step in month to extract
+        step0 (int): first time step in month to extract
+        step1 (int): time step in month to stop before
         latmask (ndarray): boolean mask for region
         lonmask (ndarray): boolean mask for region
+        cellmask (ndarray): cells of the region to read, see read_region
         
     Returns:
-        output (ndarray)
+        output (ndarray): first dimension is time
     '''
     
     decode_var = {'tp':precipname[forcing], 't2m':tempname[forcing]}
+    steps = slice(step0, step1)
     
     if isin(forcing, ['MERRA2']):
         
         if (latmask.size == 1) & (lonmask.size == 1):
-            output = data[decode_var[forcing_var]][step].values
+            output = data[decode_var[forcing_var]][steps].values
         elif (latmask.size == 1):
-            output = data[decode_var[forcing_var]][step,lonmask].values
+            output = data[decode_var[forcing_var]][steps,lonmask].values
         elif (lonmask.size == 1):
-            output = data[decode_var[forcing_var]][step,latmask].values
+            output = data[decode_var[forcing_var]][steps,latmask].values
         else:
-            output = data[decode_var[forcing_var]][step,latmask,lonmask].values
+            output = read_region(data[decode_var[forcing_var]], steps, latmask, lonmask, values=True, cellmask=cellmask)
             
     else:
         if (latmask.size == 1) & (lonmask.size == 1):
-            output = data[decode_var[forcing_var]][step]
+            output = data[decode_var[forcing_var]][steps]
         elif (latmask.size == 1):
-            output = data[decode_var[forcing_var]][step,lonmask]
+            output = data[decode_var[forcing_var]][steps,lonmask]
         elif (lonmask.size == 1):
-            output = data[decode_var[forcing_var]][step,latmask]
+            output = data[decode_var[forcing_var]][steps,latmask]
         else:
-            output = data[decode_var[forcing_var]][step,latmask,lonmask]
+            output = read_region(data[decode_var[forcing_var]], steps, latmask, lonmask, cellmask=cellmask)
 
     return output
 
@@ -186,3 +280,32 @@ def monthly_out_name(Unique_ID, month, mixed_pr, year_tag):
     
     return savename
 
+def out_prefix(Unique_ID, mixed_pr):
+    '''Start of the filenames of the annual output, climatology, point
+       store and model state.'''
+
+    savename = Unique_ID
+    if mixed_pr[0] != mixed_pr[1]:
+        savename += '.mixedpr'
+
+    return savename
+
+def annual_out_name(Unique_ID, mixed_pr, year_tag):
+    '''Construct annual output filename.'''
+    
+    return f'{out_prefix(Unique_ID, mixed_pr)}.annual.{year_tag}.nc'
+
+def stats_name(Unique_ID, output_loc, mixed_pr, worker):
+    '''Construct running statistics filename.'''
+
+    return output_loc + f'{out_prefix(Unique_ID, mixed_pr)}.climstats.{worker}.nc'
+
+def points_name(Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Construct point store filename.'''
+
+    return output_loc + f'{out_prefix(Unique_ID, mixed_pr)}.points.{year_tag}.nc'
+
+def state_name(Unique_ID, output_loc, mixed_pr, year_tag):
+    '''Construct model state filename.'''
+
+    return output_loc + f'{out_prefix(Unique_ID, mixed_pr)}.state.{year_tag}.nc'